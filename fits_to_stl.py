@@ -1,9 +1,882 @@
 # Enzo Peres Afonso 2025
 import argparse
+import functools
+import json
+import math
+import os
 import numpy as np
 from astropy.io import fits
-from stl import mesh
-from scipy.ndimage import gaussian_filter, zoom
+
+try:
+    import fitsio
+except ImportError:
+    fitsio = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    import cupy as cp
+    import cupyx.scipy.ndimage as cupy_ndimage
+    import cupyx.scipy.signal as cupy_signal
+    # CuPy imports fine on machines without a usable CUDA device or driver;
+    # treat those the same as CuPy not being installed.
+    if not cp.cuda.is_available():
+        raise ImportError("CuPy is installed but no CUDA device is available")
+except ImportError:
+    cp = None
+    cupy_ndimage = None
+    cupy_signal = None
+
+# Errors that make a GPU step fall back to the CPU instead of aborting.
+if cp is not None:
+    GPU_ERRORS = (cp.cuda.memory.OutOfMemoryError, cp.cuda.runtime.CUDARuntimeError,
+                  cp.cuda.driver.CUDADriverError)
+else:
+    GPU_ERRORS = ()
+
+# Arrays with at least this many elements use the histogram-based percentile
+# estimate instead of an exact selection.
+APPROX_PERCENTILE_MIN_SIZE = 10_000_000
+APPROX_PERCENTILE_BINS = 65536
+
+# Images with at least this many pixels are processed on the GPU when CuPy
+# is installed; below it the transfer cost outweighs the gain.
+GPU_MIN_PIXELS = 4_000_000
+
+# Arrays with at least this many pixels use the Numba kernels when numba is
+# installed. Below it the one-time JIT compile (several seconds on a cold
+# cache) and thread start-up cost more than the NumPy/scipy paths.
+NUMBA_MIN_PIXELS = 4_000_000
+
+# FITS images are read and converted to float32 in row strips of about this
+# many pixels, so the on-disk (or float64-scaled) copy never exists in full.
+FITS_READ_STRIP_PIXELS = 4_000_000
+
+# The GPU mesh build works on bands of grid rows holding about this many
+# triangles (~240 MB of coordinates and normals on the device).
+GPU_MESH_BAND_FACES = 5_000_000
+
+# Binary STL triangle record: normal, three vertices, attribute byte count.
+STL_DTYPE = np.dtype([
+    ('normals', '<f4', (3,)),
+    ('vectors', '<f4', (3, 3)),
+    ('attr', '<u2'),
+])
+STL_HEADER = b'AstroTouch fits_to_stl binary STL'.ljust(80, b' ')
+
+# Meshes with at least this many triangles (~1 GB of STL) are built directly
+# in a memory-mapped output file instead of in RAM.
+MEMMAP_MIN_FACES = 20_000_000
+
+OUTPUT_FORMATS = ('stl', 'ply', 'gltf')
+
+# The NumPy height-map pipeline runs over row tiles of about this many
+# pixels (256 KB of float32), so its chained in-place passes stay in L2.
+HEIGHT_MAP_TILE_PIXELS = 65536
+
+# Above this sigma the CuPy smoothing path switches to an FFT convolution,
+# whose cost does not grow with the kernel radius.
+GAUSSIAN_FFT_SIGMA = 3.0
+
+
+def _exact_percentile(a, ps):
+    """
+    Exact percentiles (numpy's default 'linear' method) using a single
+    np.partition call for all requested ranks.
+    """
+    a = a.ravel()
+    ranks = np.asarray(ps, dtype=np.float64) / 100.0 * (a.size - 1)
+    lo = np.floor(ranks).astype(np.intp)
+    hi = np.minimum(lo + 1, a.size - 1)
+    part = np.partition(a, np.unique(np.concatenate([lo, hi])))
+    frac = (ranks - lo).astype(a.dtype)
+    return part[lo] + (part[hi] - part[lo]) * frac
+
+
+if numba is not None:
+    # The reductions below split the flat array into one chunk per thread,
+    # so each thread keeps private accumulators that are combined at the end.
+    @numba.njit(parallel=True, cache=True)
+    def _finite_stats_kernel(flat, n_chunks):
+        chunk = (flat.size + n_chunks - 1) // n_chunks
+        bad = np.zeros(n_chunks, dtype=np.int64)
+        mins = np.full(n_chunks, np.inf)
+        maxs = np.full(n_chunks, -np.inf)
+        for c in numba.prange(n_chunks):
+            n_bad = 0
+            mn, mx = np.inf, -np.inf
+            for k in range(c * chunk, min((c + 1) * chunk, flat.size)):
+                v = flat[k]
+                if math.isfinite(v):
+                    mn = min(mn, v)
+                    mx = max(mx, v)
+                else:
+                    n_bad += 1
+            bad[c] = n_bad
+            mins[c] = mn
+            maxs[c] = mx
+        return bad.sum(), mins.min(), maxs.max()
+
+    @numba.njit(parallel=True, cache=True)
+    def _finite_histogram_kernel(flat, lo, hi, bins, n_chunks):
+        chunk = (flat.size + n_chunks - 1) // n_chunks
+        counts = np.zeros((n_chunks, bins), dtype=np.int64)
+        norm = bins / (hi - lo)
+        for c in numba.prange(n_chunks):
+            for k in range(c * chunk, min((c + 1) * chunk, flat.size)):
+                v = flat[k]
+                # NaN and +/-inf fail this test, so they are never counted.
+                if v >= lo and v <= hi:
+                    b = min(int((v - lo) * norm), bins - 1)
+                    counts[c, b] += 1
+        hist = np.zeros(bins, dtype=np.int64)
+        for c in range(n_chunks):
+            hist += counts[c]
+        return hist
+
+
+def _finite_minmax(a):
+    """(min, max) over the finite values of `a`, in a single pass on the Numba path."""
+    flat = a.ravel()
+    if not _use_numba(flat.size):
+        mn, mx = flat.min(), flat.max()
+        if not (np.isfinite(mn) and np.isfinite(mx)):
+            # NaN/inf present: only now pay for the masked copy.
+            finite = flat[np.isfinite(flat)]
+            mn, mx = finite.min(), finite.max()
+        return mn, mx
+    _, mn, mx = _finite_stats_kernel(flat, numba.get_num_threads())
+    return a.dtype.type(mn), a.dtype.type(mx)
+
+
+def _finite_stats(a):
+    """
+    (number of NaN/inf values, finite min, finite max) of `a`. With Numba this
+    is one sweep that neither allocates a mask nor copies the finite values.
+    If nothing is finite, min and max come back as +inf and -inf.
+    """
+    flat = a.ravel()
+    if not _use_numba(flat.size):
+        finite = np.isfinite(flat)
+        n_bad = int(flat.size - np.count_nonzero(finite))
+        if n_bad == flat.size:
+            return n_bad, a.dtype.type(np.inf), a.dtype.type(-np.inf)
+        values = flat[finite] if n_bad else flat
+        return n_bad, values.min(), values.max()
+    n_bad, mn, mx = _finite_stats_kernel(flat, numba.get_num_threads())
+    return int(n_bad), a.dtype.type(mn), a.dtype.type(mx)
+
+
+def _finite_histogram(a, lo, hi, bins):
+    """Linear histogram of the finite values of `a` over [lo, hi], without a mask copy."""
+    if not _use_numba(a.size):
+        # Values outside an explicit range, including NaN/inf, are dropped.
+        return np.histogram(a, bins=bins, range=(lo, hi))[0]
+    return _finite_histogram_kernel(a.ravel(), float(lo), float(hi), bins, numba.get_num_threads())
+
+
+def _approx_percentile(a, ps, bins=APPROX_PERCENTILE_BINS, minmax=None):
+    """
+    Approximate percentiles of the finite values of `a` from a single linear
+    histogram pass. The result is interpolated inside the bin holding each
+    rank, so the error is bounded by the bin width, (max - min) / bins.
+    `minmax` is the finite (min, max) of `a` if the caller already has it.
+    """
+    lo, hi = minmax if minmax is not None else _finite_minmax(a)
+    if lo == hi:
+        return np.full(len(ps), lo, dtype=a.dtype)
+    h = _finite_histogram(a, lo, hi, bins)
+    edges = np.linspace(lo, hi, bins + 1)
+    cdf = np.cumsum(h)
+    targets = np.asarray(ps, dtype=np.float64) / 100.0 * cdf[-1]
+    idx = np.clip(np.searchsorted(cdf, targets), 0, bins - 1)
+    below = np.where(idx > 0, cdf[idx - 1], 0)
+    frac = (targets - below) / np.maximum(h[idx], 1)
+    return (edges[idx] + frac * (edges[idx + 1] - edges[idx])).astype(a.dtype)
+
+
+def _percentiles(a, ps, skip_nonfinite=False, minmax=None):
+    """
+    Returns the percentiles `ps` of `a`, approximating for very large arrays.
+    With `skip_nonfinite`, NaN/inf values are left out of the statistics; the
+    histogram path does that on the fly, without copying the finite values.
+    A known finite (min, max) can be passed as `minmax` to save the histogram
+    path its range sweep.
+    """
+    if a.size >= APPROX_PERCENTILE_MIN_SIZE:
+        return _approx_percentile(a, ps, minmax=minmax)
+    if skip_nonfinite:
+        a = a[np.isfinite(a)]
+    return _exact_percentile(a, ps)
+
+
+def _use_gpu(num_pixels, use_gpu=None):
+    """
+    Decides whether an array of `num_pixels` goes to the GPU. `use_gpu` is
+    True (always, when CuPy is available), False (never) or None (only if
+    the array is large enough to be worth the transfer).
+    """
+    if cp is None or use_gpu is False:
+        return False
+    return use_gpu or num_pixels >= GPU_MIN_PIXELS
+
+
+def _use_numba(num_pixels):
+    """Whether an array of `num_pixels` is processed with the Numba kernels."""
+    return numba is not None and num_pixels >= NUMBA_MIN_PIXELS
+
+
+def _read_rows_float32(shape, read_rows):
+    """
+    Assembles a 2D float32 image from `read_rows(start, stop)`, which returns
+    rows start:stop in the file's own dtype. Only one strip of the unconverted
+    data is held at a time.
+    """
+    ny, nx = shape
+    image_data = np.empty((ny, nx), dtype=np.float32)
+    step = max(1, FITS_READ_STRIP_PIXELS // max(nx, 1))
+    for start in range(0, ny, step):
+        stop = min(start + step, ny)
+        image_data[start:stop] = read_rows(start, stop)
+    return image_data
+
+
+def _read_fits_image(fits_filepath, hdu_index):
+    """
+    Reads a 2D image HDU as float32. CFITSIO (via fitsio) is used when it is
+    installed, since it decodes straight into a typed array; otherwise
+    astropy.io.fits is used. Either way the image is read in row strips
+    (tile by tile for compressed HDUs) rather than loaded whole and cast.
+
+    Returns (image_data, all_finite). `all_finite` is True when the HDU stores
+    integers without a BLANK value, so no pixel can be NaN or inf and callers
+    can skip scanning for them.
+    """
+    if fitsio is not None:
+        if not os.path.isfile(fits_filepath):
+            raise FileNotFoundError(fits_filepath)
+        with fitsio.FITS(fits_filepath) as f:
+            if len(f) <= hdu_index:
+                raise ValueError(f"HDU index {hdu_index} out of range. Max index: {len(f)-1}")
+            hdu = f[hdu_index]
+            if hdu.get_exttype() != 'IMAGE_HDU' or hdu.get_info()['ndims'] != 2:
+                raise ValueError(f"HDU {hdu_index} does not contain 2D image data.")
+            header = hdu.read_header()
+            blank = header.get('BLANK', header.get('ZBLANK'))
+            is_integer = hdu.get_info()['img_type'] > 0
+            if not is_integer or blank is None:
+                return _read_rows_float32(hdu.get_dims(), lambda start, stop: hdu[start:stop, :]), is_integer
+
+            # fitsio hands BLANK pixels back as the raw sentinel value (scaled
+            # like any other pixel), where astropy gives NaN. Read the stored
+            # integers and apply BSCALE/BZERO here so the sentinel can be
+            # matched exactly and turned into NaN, as the astropy path does.
+            hdu.ignore_scaling = True
+            bscale, bzero = header.get('BSCALE', 1.0), header.get('BZERO', 0.0)
+
+            def read_rows(start, stop):
+                raw = hdu[start:stop, :]
+                rows = raw.astype(np.float64)
+                if bscale != 1 or bzero != 0:
+                    rows *= bscale
+                    rows += bzero
+                rows[raw == blank] = np.nan
+                return rows
+            return _read_rows_float32(hdu.get_dims(), read_rows), False
+
+    with fits.open(fits_filepath) as hdul:
+        if len(hdul) <= hdu_index:
+            raise ValueError(f"HDU index {hdu_index} out of range. Max index: {len(hdul)-1}")
+        hdu = hdul[hdu_index]
+        # Checked from the header, so no data is loaded before the strip reads.
+        if not hdu.is_image or len(hdu.shape) != 2:
+             raise ValueError(f"HDU {hdu_index} does not contain 2D image data.")
+        all_finite = hdu.header['BITPIX'] > 0 and 'BLANK' not in hdu.header
+        return _read_rows_float32(hdu.shape, lambda start, stop: hdu.section[start:stop]), all_finite
+
+
+def _downsample(image_data, factor, use_gpu=None):
+    """
+    Shrinks the image by `factor`. Integer factors use a block mean, i.e. each
+    output pixel is exactly the average of an f x f box of input pixels, after
+    cropping the image to a multiple of f. Other factors fall back to linear
+    interpolation with scipy's zoom. Large images are processed with CuPy
+    when it is available, and on the CPU if the GPU step fails.
+    """
+    if _use_gpu(image_data.size, use_gpu):
+        try:
+            return _downsample_array(image_data, factor, gpu=True)
+        except GPU_ERRORS as e:
+            print(f"WARNING: GPU downsampling failed ({e}). Using the CPU instead.")
+    return _downsample_array(image_data, factor, gpu=False)
+
+
+def _downsample_array(image_data, factor, gpu):
+    """The computation behind _downsample, on the GPU or the CPU."""
+    xp = cp if gpu else np
+    data = cp.asarray(image_data) if gpu else image_data
+    f = int(factor)
+    if f == factor:
+        ny2, nx2 = data.shape[0] // f, data.shape[1] // f
+        blocks = data[:ny2 * f, :nx2 * f].reshape(ny2, f, nx2, f)
+        result = blocks.mean(axis=(1, 3), dtype=xp.float32)
+    else:
+        if gpu:
+            resample = cupy_ndimage.zoom
+        else:
+            from scipy.ndimage import zoom as resample
+        result = resample(data, 1 / factor, order=1, prefilter=False, mode='nearest')
+    return cp.asnumpy(result) if gpu else result
+
+
+def _height_map_numpy(image_data, lo, hi, replace_val, shift, log_scale, invert, z_lo, scale, base):
+    """
+    NumPy version of the fused preprocessing in _height_map. The passes are
+    chained in place over one cache-sized tile of rows at a time, so each
+    pixel is fetched from main memory once rather than once per pass.
+    """
+    z_data = np.empty(image_data.shape, dtype=np.float32)
+    replace_val = np.float32(replace_val)
+    lo, hi, shift = np.float32(lo), np.float32(hi), np.float32(shift)
+    # Inversion and normalization fold into one multiply-add:
+    # base + (+/-v - z_lo) * scale == v * (+/-scale) + (base - z_lo * scale)
+    factor = np.float32(-scale if invert else scale)
+    offset = np.float32(base) - np.float32(z_lo) * np.float32(scale)
+
+    nx = image_data.shape[1]
+    tile_rows = max(1, HEIGHT_MAP_TILE_PIXELS // nx)
+    for start in range(0, image_data.shape[0], tile_rows):
+        tile = z_data[start:start + tile_rows]
+        np.copyto(tile, image_data[start:start + tile_rows])
+        # nan_to_num replaces in place without materializing an isfinite mask.
+        np.nan_to_num(tile, copy=False, nan=replace_val, posinf=replace_val, neginf=replace_val)
+        np.clip(tile, lo, hi, out=tile)
+        if log_scale:
+            np.subtract(tile, shift, out=tile)
+            np.log1p(tile, out=tile)
+        np.multiply(tile, factor, out=tile)
+        np.add(tile, offset, out=tile)
+    return z_data
+
+
+if numba is not None:
+    # fastmath is deliberately off here, as in the reductions above: it lets
+    # LLVM assume values are finite and drop the isfinite() tests.
+    @numba.njit(parallel=True, cache=True)
+    def _height_map_kernel(image_data, z_data, lo, hi, replace_val, invert, z_lo, scale, base):
+        ny, nx = image_data.shape
+        for j in numba.prange(ny):
+            for i in range(nx):
+                v = image_data[j, i]
+                if not math.isfinite(v):
+                    v = replace_val
+                v = min(max(v, lo), hi)
+                if invert:
+                    v = -v
+                z_data[j, i] = base + (v - z_lo) * scale
+
+
+def _height_map(image_data, lo, hi, replace_val, shift, log_scale, invert, z_lo, scale, base):
+    """
+    Turns raw pixel values into Z heights in one sweep over the image:
+    non-finite replacement, clipping to [lo, hi], optional log1p (after
+    subtracting `shift`) and inversion, then the affine map
+    base + (v - z_lo) * scale. Large images use a parallel Numba kernel when
+    numba is installed (see _use_numba); the rest go through the tiled NumPy
+    pipeline.
+
+    log1p always takes the NumPy path: NumPy's SIMD log1p is around 20x
+    faster per element than the scalar libm call a Numba loop makes, which
+    outweighs the kernel's threading on ordinary core counts.
+    """
+    if log_scale or not _use_numba(image_data.size):
+        return _height_map_numpy(image_data, lo, hi, replace_val, shift, log_scale, invert, z_lo, scale, base)
+    z_data = np.empty(image_data.shape, dtype=np.float32)
+    f32 = np.float32
+    _height_map_kernel(image_data, z_data, f32(lo), f32(hi), f32(replace_val),
+                       bool(invert), f32(z_lo), f32(scale), f32(base))
+    return z_data
+
+
+def _gaussian_weights(sigma, truncate=4.0):
+    """Normalized 1D Gaussian weights with the same support as scipy's gaussian_filter."""
+    radius = int(truncate * sigma + 0.5)
+    x = np.arange(-radius, radius + 1, dtype=np.float64)
+    weights = np.exp(-0.5 * (x / sigma) ** 2)
+    return weights / weights.sum()
+
+
+if numba is not None:
+    @numba.njit(inline='always')
+    def _reflect(idx, n):
+        # scipy.ndimage 'reflect' boundary: (d c b a | a b c d | d c b a)
+        idx = idx % (2 * n)
+        if idx >= n:
+            idx = 2 * n - 1 - idx
+        return idx
+
+    # Both correlation passes are written as weighted row accumulations
+    # (acc += w * row) so the inner loop is contiguous and vectorizes; the
+    # boundary is handled once per row instead of once per tap.
+    @numba.njit(parallel=True, cache=True)
+    def _correlate_rows(src, dst, weights):
+        ny, nx = src.shape
+        radius = (weights.size - 1) // 2
+        for j in numba.prange(ny):
+            padded = np.empty(nx + 2 * radius, dtype=np.float64)
+            for i in range(nx + 2 * radius):
+                padded[i] = src[j, _reflect(i - radius, nx)]
+            acc = np.zeros(nx, dtype=np.float64)
+            for k in range(weights.size):
+                w = weights[k]
+                for i in range(nx):
+                    acc[i] += w * padded[i + k]
+            for i in range(nx):
+                dst[j, i] = acc[i]
+
+    @numba.njit(parallel=True, cache=True)
+    def _correlate_cols(src, dst, weights):
+        ny, nx = src.shape
+        radius = (weights.size - 1) // 2
+        for j in numba.prange(ny):
+            acc = np.zeros(nx, dtype=np.float64)
+            for k in range(weights.size):
+                w = weights[k]
+                row = _reflect(j + k - radius, ny)
+                for i in range(nx):
+                    acc[i] += w * src[row, i]
+            for i in range(nx):
+                dst[j, i] = acc[i]
+
+def _gaussian_smooth_gpu(z_data, sigma):
+    """
+    CuPy Gaussian smoothing. Large kernels use an FFT convolution of the
+    reflect-padded image, which matches gaussian_filter's boundary handling
+    and costs the same for any sigma.
+    """
+    z = cp.asarray(z_data)
+    if sigma <= GAUSSIAN_FFT_SIGMA:
+        return cp.asnumpy(cupy_ndimage.gaussian_filter(z, sigma=sigma))
+    w = cp.asarray(_gaussian_weights(sigma), dtype=cp.float32)
+    radius = (w.size - 1) // 2
+    padded = cp.pad(z, radius, mode='symmetric')
+    return cp.asnumpy(cupy_signal.fftconvolve(padded, cp.outer(w, w), mode='valid').astype(cp.float32))
+
+
+def _gaussian_smooth(z_data, sigma, use_gpu=None):
+    """
+    Separable Gaussian smoothing with scipy's default 'reflect' boundary.
+    On the Numba path (see _use_numba) this runs as two parallel 1D passes
+    with the same weights as gaussian_filter; otherwise it defers to
+    scipy.ndimage.gaussian_filter. See _use_gpu for when CuPy is used
+    instead; a failing GPU step falls back to the CPU. Every backend computes the exact Gaussian, so the result does
+    not depend on which optional packages are installed.
+    """
+    if _use_gpu(z_data.size, use_gpu):
+        try:
+            return _gaussian_smooth_gpu(z_data, sigma)
+        except GPU_ERRORS as e:
+            print(f"WARNING: GPU smoothing failed ({e}). Using the CPU instead.")
+    if not _use_numba(z_data.size):
+        from scipy.ndimage import gaussian_filter
+        return gaussian_filter(z_data, sigma=sigma)
+    src = np.ascontiguousarray(z_data, dtype=np.float32)
+    weights = _gaussian_weights(sigma)
+    tmp = np.empty_like(src)
+    out = np.empty_like(src)
+    _correlate_rows(src, tmp, weights)
+    _correlate_cols(tmp, out, weights)
+    return out
+
+
+def _index_dtype(num_vertices):
+    """
+    Smallest unsigned index type that PLY and glTF can store for a mesh with
+    `num_vertices` vertices: uint16 for small meshes, otherwise uint32. The
+    type's maximum value is never used as an index, since glTF reserves it
+    as the primitive-restart value.
+    """
+    if num_vertices < 2**16:
+        return np.uint16
+    if num_vertices < 2**32:
+        return np.uint32
+    raise ValueError(f"Mesh has {num_vertices} vertices; indexed formats support fewer than 2**32.")
+
+
+def _grid_faces(nx, ny):
+    """
+    Triangle vertex indices for the closed relief solid on an nx x ny grid.
+    Indices below nx*ny refer to the top surface, the rest to the matching
+    vertex of the flat base. The index dtype is the smallest that fits, see
+    _index_dtype.
+    """
+    num_faces_per_surface = 2 * (nx - 1) * (ny - 1)
+    num_side_faces = 2 * (nx - 1) + 2 * (ny - 1)
+    base_offset = nx * ny
+    idx_dtype = _index_dtype(2 * nx * ny)
+    faces = np.empty((num_faces_per_surface * 2 + num_side_faces * 2, 3), dtype=idx_dtype)
+
+    # Top and bottom surfaces: two triangles per grid cell, written for all
+    # cells at once into (cell, triangle, corner) views of their slice of
+    # `faces`, so the face order matches a row-major walk over the grid and
+    # no per-triangle stacks are built. The cell index grid comes from
+    # broadcasting a row offset column against a column index row, so no
+    # meshgrid temporaries are allocated.
+    row_start = np.arange(ny - 1, dtype=idx_dtype)[:, None] * nx
+    v00 = (row_start + np.arange(nx - 1, dtype=idx_dtype)).ravel()
+    v10 = v00 + 1
+    v01 = v00 + nx
+    v11 = v01 + 1
+
+    top = faces[:num_faces_per_surface].reshape(-1, 2, 3)
+    top[:, 0, 0], top[:, 0, 1], top[:, 0, 2] = v00, v10, v01
+    top[:, 1, 0], top[:, 1, 1], top[:, 1, 2] = v10, v11, v01
+
+    # The bottom surface uses the same cells with reversed winding so its
+    # normals point down.
+    bottom = faces[num_faces_per_surface:2 * num_faces_per_surface].reshape(-1, 2, 3)
+    bottom[:, 0, 0], bottom[:, 0, 1], bottom[:, 0, 2] = v00, v01, v10
+    bottom[:, 1, 0], bottom[:, 1, 1], bottom[:, 1, 2] = v10, v01, v11
+    bottom += base_offset
+
+    # Side walls: each edge segment joins two top vertices to the two base
+    # vertices below them. The front/back and left/right walls are emitted
+    # in pairs per segment, four triangles at a time, into
+    # (segment, triangle, corner) views of the remaining slices.
+    x_start = 2 * num_faces_per_surface
+    y_start = x_start + 4 * (nx - 1)
+
+    i = np.arange(nx - 1, dtype=idx_dtype)
+    front_t0, front_t1 = i, i + 1
+    back_t0, back_t1 = (ny - 1) * nx + i, (ny - 1) * nx + i + 1
+    xs = faces[x_start:y_start].reshape(-1, 4, 3)
+    xs[:, 0, 0], xs[:, 0, 1], xs[:, 0, 2] = front_t0, front_t0 + base_offset, front_t1 + base_offset
+    xs[:, 1, 0], xs[:, 1, 1], xs[:, 1, 2] = front_t0, front_t1 + base_offset, front_t1
+    xs[:, 2, 0], xs[:, 2, 1], xs[:, 2, 2] = back_t0, back_t1 + base_offset, back_t0 + base_offset
+    xs[:, 3, 0], xs[:, 3, 1], xs[:, 3, 2] = back_t0, back_t1, back_t1 + base_offset
+
+    j = np.arange(ny - 1, dtype=idx_dtype)
+    left_t0, left_t1 = j * nx, (j + 1) * nx
+    right_t0, right_t1 = left_t0 + (nx - 1), left_t1 + (nx - 1)
+    ys = faces[y_start:].reshape(-1, 4, 3)
+    ys[:, 0, 0], ys[:, 0, 1], ys[:, 0, 2] = left_t0, left_t1 + base_offset, left_t0 + base_offset
+    ys[:, 1, 0], ys[:, 1, 1], ys[:, 1, 2] = left_t0, left_t1, left_t1 + base_offset
+    ys[:, 2, 0], ys[:, 2, 1], ys[:, 2, 2] = right_t0, right_t0 + base_offset, right_t1 + base_offset
+    ys[:, 3, 0], ys[:, 3, 1], ys[:, 3, 2] = right_t0, right_t1 + base_offset, right_t1
+    return faces
+
+
+@functools.lru_cache(maxsize=1)
+def _cached_grid_faces(nx, ny):
+    """
+    _grid_faces, memoized for the last grid shape. The indices depend only
+    on (nx, ny), so batch runs over same-sized images reuse them; only one
+    entry is kept because a large grid's faces take hundreds of MB. The
+    array is returned read-only because it is shared between calls.
+    """
+    faces = _grid_faces(nx, ny)
+    faces.setflags(write=False)
+    return faces
+
+
+def _fill_grid_vectors(vectors, x, y, z_data, surfaces=True, walls=True):
+    """
+    Writes the (F, 3, 3) triangle coordinates of the relief solid into
+    `vectors`, in the face order of _grid_faces. Every corner of every
+    triangle is a fixed offset into the grid, so each one is filled from a
+    shifted slice of x, y and z_data; no face index array or gather is
+    needed. Works for numpy and cupy arrays alike. With surfaces=False only
+    the side walls are written; with walls=False only the top and bottom
+    surfaces, so `vectors` may then hold just those 2 * 2(nx-1)(ny-1) faces.
+    """
+    ny, nx = z_data.shape
+    num_faces_per_surface = 2 * (nx - 1) * (ny - 1)
+    y_col = y[:, None]
+
+    def put(block, tri, corner, xv, yv, zv):
+        block[..., tri, corner, 0] = xv
+        block[..., tri, corner, 1] = yv
+        block[..., tri, corner, 2] = zv
+
+    # Grid cell corners (j, i), (j, i+1), (j+1, i), (j+1, i+1) as x/y/z slices.
+    c00 = (x[:-1], y_col[:-1], z_data[:-1, :-1])
+    c10 = (x[1:], y_col[:-1], z_data[:-1, 1:])
+    c01 = (x[:-1], y_col[1:], z_data[1:, :-1])
+    c11 = (x[1:], y_col[1:], z_data[1:, 1:])
+
+    if surfaces:
+        top = vectors[:num_faces_per_surface].reshape(ny - 1, nx - 1, 2, 3, 3)
+        for tri, corners in enumerate(((c00, c10, c01), (c10, c11, c01))):
+            for corner, (xv, yv, zv) in enumerate(corners):
+                put(top, tri, corner, xv, yv, zv)
+
+        bottom = vectors[num_faces_per_surface:2 * num_faces_per_surface].reshape(ny - 1, nx - 1, 2, 3, 3)
+        for tri, corners in enumerate(((c00, c01, c10), (c10, c01, c11))):
+            for corner, (xv, yv, _) in enumerate(corners):
+                put(bottom, tri, corner, xv, yv, 0.0)
+    if not walls:
+        return
+
+    # Side walls, four triangles per edge segment as in _grid_faces. Each
+    # corner is (x, y, z) with z taken from the edge row/column or 0.
+    x_start = 2 * num_faces_per_surface
+    y_start = x_start + 4 * (nx - 1)
+    xs = vectors[x_start:y_start].reshape(nx - 1, 4, 3, 3)
+    f0, f1 = (x[:-1], y[0], z_data[0, :-1]), (x[1:], y[0], z_data[0, 1:])
+    b0, b1 = (x[:-1], y[-1], z_data[-1, :-1]), (x[1:], y[-1], z_data[-1, 1:])
+    ys = vectors[y_start:].reshape(ny - 1, 4, 3, 3)
+    l0, l1 = (x[0], y[:-1], z_data[:-1, 0]), (x[0], y[1:], z_data[1:, 0])
+    r0, r1 = (x[-1], y[:-1], z_data[:-1, -1]), (x[-1], y[1:], z_data[1:, -1])
+
+    def base(c):
+        return (c[0], c[1], 0.0)
+
+    for block, triangles in (
+        (xs, ((f0, base(f0), base(f1)), (f0, base(f1), f1), (b0, base(b1), base(b0)), (b0, b1, base(b1)))),
+        (ys, ((l0, base(l1), base(l0)), (l0, l1, base(l1)), (r0, base(r0), base(r1)), (r0, base(r1), r1))),
+    ):
+        for tri, corners in enumerate(triangles):
+            for corner, (xv, yv, zv) in enumerate(corners):
+                put(block, tri, corner, xv, yv, zv)
+
+
+def _face_normals(vectors, xp=np):
+    """Unit normal of each triangle in `vectors` (right-hand rule)."""
+    normals = xp.cross(vectors[:, 1] - vectors[:, 0], vectors[:, 2] - vectors[:, 0])
+    normals /= xp.linalg.norm(normals, axis=1, keepdims=True).clip(1e-30)
+    return normals
+
+
+def _fill_grid_normals(normals, vectors, nx, ny, xp=np, surfaces=True, walls=True):
+    """
+    Writes the (F, 3) unit normals of the relief solid into `normals`, in the
+    face order of _grid_faces. Only the top surface needs a cross product;
+    the flat base and the four side walls have constant outward normals that
+    are set directly. `surfaces` and `walls` select the faces to write, as
+    in _fill_grid_vectors.
+    """
+    num_faces_per_surface = 2 * (nx - 1) * (ny - 1)
+    x_start = 2 * num_faces_per_surface
+    y_start = x_start + 4 * (nx - 1)
+
+    if surfaces:
+        normals[:num_faces_per_surface] = _face_normals(vectors[:num_faces_per_surface], xp)
+        normals[num_faces_per_surface:x_start] = (0.0, 0.0, -1.0)
+    if not walls:
+        return
+
+    # Wall triangles come in groups of four per edge segment: two for the
+    # front/left wall followed by two for the back/right wall.
+    xs = normals[x_start:y_start].reshape(nx - 1, 2, 2, 3)
+    xs[:, 0] = (0.0, -1.0, 0.0)
+    xs[:, 1] = (0.0, 1.0, 0.0)
+    ys = normals[y_start:].reshape(ny - 1, 2, 2, 3)
+    ys[:, 0] = (-1.0, 0.0, 0.0)
+    ys[:, 1] = (1.0, 0.0, 0.0)
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _put_triangle(vectors, normals, f, ax, ay, az, bx, by, bz, cx, cy, cz):
+        vectors[f, 0, 0], vectors[f, 0, 1], vectors[f, 0, 2] = ax, ay, az
+        vectors[f, 1, 0], vectors[f, 1, 1], vectors[f, 1, 2] = bx, by, bz
+        vectors[f, 2, 0], vectors[f, 2, 1], vectors[f, 2, 2] = cx, cy, cz
+        ux, uy, uz = bx - ax, by - ay, bz - az
+        vx, vy, vz = cx - ax, cy - ay, cz - az
+        nx = uy * vz - uz * vy
+        ny = uz * vx - ux * vz
+        nz = ux * vy - uy * vx
+        length = max(math.sqrt(nx * nx + ny * ny + nz * nz), 1e-30)
+        normals[f, 0], normals[f, 1], normals[f, 2] = nx / length, ny / length, nz / length
+
+    @numba.njit(parallel=True, cache=True)
+    def _surface_mesh_kernel(vectors, normals, x, y, z_data):
+        ny, nx = z_data.shape
+        num_faces_per_surface = 2 * (nx - 1) * (ny - 1)
+        for j in numba.prange(ny - 1):
+            y0, y1 = y[j], y[j + 1]
+            for i in range(nx - 1):
+                x0, x1 = x[i], x[i + 1]
+                z00, z10 = z_data[j, i], z_data[j, i + 1]
+                z01, z11 = z_data[j + 1, i], z_data[j + 1, i + 1]
+                f = 2 * (j * (nx - 1) + i)
+                _put_triangle(vectors, normals, f, x0, y0, z00, x1, y0, z10, x0, y1, z01)
+                _put_triangle(vectors, normals, f + 1, x1, y0, z10, x1, y1, z11, x0, y1, z01)
+                b = num_faces_per_surface + f
+                _put_triangle(vectors, normals, b, x0, y0, 0.0, x0, y1, 0.0, x1, y0, 0.0)
+                _put_triangle(vectors, normals, b + 1, x1, y0, 0.0, x0, y1, 0.0, x1, y1, 0.0)
+
+
+def _fill_grid_mesh(vectors, normals, x, y, z_data):
+    """
+    Fills the triangle coordinates and normals of the relief solid on the
+    CPU, in the face order of _grid_faces. On the Numba path (see _use_numba)
+    the top and bottom surfaces, which are nearly all of the faces, are
+    written by a parallel kernel in a single pass per grid row with no
+    temporaries; the side walls always use the NumPy fill.
+    """
+    ny, nx = z_data.shape
+    if not _use_numba(z_data.size):
+        _fill_grid_vectors(vectors, x, y, z_data)
+        _fill_grid_normals(normals, vectors, nx, ny)
+        return
+    _surface_mesh_kernel(vectors, normals, x, y, z_data)
+    _fill_grid_vectors(vectors, x, y, z_data, surfaces=False)
+    _fill_grid_normals(normals, vectors, nx, ny, surfaces=False)
+
+
+def _fill_grid_mesh_gpu(vectors, normals, x, y, z_data):
+    """
+    CuPy version of _fill_grid_mesh. The top and bottom surfaces are built on
+    the device one band of grid rows at a time (GPU_MESH_BAND_FACES faces)
+    and copied into the matching slices of the host `vectors` and `normals`,
+    so neither device memory nor host temporaries grow with the mesh, and a
+    memory-mapped STL buffer stays paged out. The side walls are filled on
+    the host. CUDA errors, e.g. running out of memory for a single band, are
+    left for the caller to handle.
+    """
+    ny, nx = z_data.shape
+    num_faces_per_surface = 2 * (nx - 1) * (ny - 1)
+    band_rows = max(1, GPU_MESH_BAND_FACES // (4 * (nx - 1)))
+    x_gpu = cp.asarray(x)
+    for j0 in range(0, ny - 1, band_rows):
+        j1 = min(j0 + band_rows, ny - 1)
+        band_faces = 2 * (nx - 1) * (j1 - j0)
+        band_vectors = cp.empty((2 * band_faces, 3, 3), dtype=cp.float32)
+        band_normals = cp.empty((2 * band_faces, 3), dtype=cp.float32)
+        _fill_grid_vectors(band_vectors, x_gpu, cp.asarray(y[j0:j1 + 1]), cp.asarray(z_data[j0:j1 + 1]),
+                           walls=False)
+        _fill_grid_normals(band_normals, band_vectors, nx, j1 - j0 + 1, cp, walls=False)
+        # Each band holds its top faces followed by its bottom faces.
+        a, b = 2 * (nx - 1) * j0, 2 * (nx - 1) * j1
+        for dst, src in ((vectors, band_vectors), (normals, band_normals)):
+            dst[a:b] = cp.asnumpy(src[:band_faces])
+            dst[num_faces_per_surface + a:num_faces_per_surface + b] = cp.asnumpy(src[band_faces:])
+    _fill_grid_vectors(vectors, x, y, z_data, surfaces=False)
+    _fill_grid_normals(normals, vectors, nx, ny, surfaces=False)
+
+
+def _new_stl_buffer(num_faces, memmap_path=None):
+    """
+    Allocates the complete binary STL file image. Returns the raw byte buffer
+    (header and triangle count already filled in) and an STL_DTYPE view of
+    the triangle records inside it, so the mesh is built in place and the
+    file can be written with a single call.
+
+    If `memmap_path` is given the buffer is a np.memmap of that file instead,
+    so the OS pages the mesh out to disk as it is produced and it never has to
+    fit in RAM.
+    """
+    size = 84 + num_faces * STL_DTYPE.itemsize
+    if memmap_path is not None:
+        buf = np.memmap(memmap_path, dtype=np.uint8, mode='w+', shape=(size,))
+    else:
+        buf = np.zeros(size, dtype=np.uint8)
+    buf[:80] = np.frombuffer(STL_HEADER, dtype=np.uint8)
+    buf[80:84] = np.frombuffer(np.uint32(num_faces).astype('<u4').tobytes(), dtype=np.uint8)
+    return buf, buf[84:].view(STL_DTYPE)
+
+
+def _write_binary_stl(stl_filepath, buf):
+    """
+    Writes a buffer from _new_stl_buffer to disk in one write call, or just
+    flushes it if it is already memory-mapped onto the file.
+    """
+    if isinstance(buf, np.memmap):
+        buf.flush()
+        return
+    with open(stl_filepath, 'wb') as f:
+        f.write(memoryview(buf))
+
+
+def _grid_vertices(x, y, z_data):
+    """
+    The unique (2*nx*ny, 3) vertex list matching _grid_faces: the top surface
+    in row-major order followed by the same grid at z=0.
+    """
+    ny, nx = z_data.shape
+    vertices = np.empty((2, ny, nx, 3), dtype=np.float32)
+    vertices[..., 0] = x
+    vertices[..., 1] = y[:, None]
+    vertices[0, ..., 2] = z_data
+    vertices[1, ..., 2] = 0.0
+    return vertices.reshape(-1, 3)
+
+
+def _write_ply(filepath, vertices, faces):
+    """Writes an indexed mesh as binary little-endian PLY."""
+    index_type, index_fmt = ('ushort', '<u2') if faces.dtype == np.uint16 else ('uint', '<u4')
+    header = (
+        "ply\n"
+        "format binary_little_endian 1.0\n"
+        "comment AstroTouch fits_to_stl\n"
+        f"element vertex {len(vertices)}\n"
+        "property float x\n"
+        "property float y\n"
+        "property float z\n"
+        f"element face {len(faces)}\n"
+        f"property list uchar {index_type} vertex_indices\n"
+        "end_header\n"
+    )
+    face_rec = np.empty(len(faces), dtype=[('n', 'u1'), ('idx', index_fmt, (3,))])
+    face_rec['n'] = 3
+    face_rec['idx'] = faces
+    with open(filepath, 'wb') as f:
+        f.write(header.encode('ascii'))
+        vertices.astype('<f4', copy=False).tofile(f)
+        face_rec.tofile(f)
+
+
+def _write_glb(filepath, vertices, faces):
+    """
+    Writes an indexed mesh as a single-file binary glTF 2.0 (.glb). glTF is
+    Y-up and in meters, so the node carries a rotation and a 0.001 scale
+    while the stored coordinates stay in millimeters.
+    """
+    # Both arrays are written straight from their buffers with tofile, so
+    # their sizes come from nbytes rather than from byte copies.
+    positions = vertices.astype('<f4', copy=False)
+    # UNSIGNED_SHORT (5123) or UNSIGNED_INT (5125), matching the face dtype.
+    index_fmt, index_component = ('<u2', 5123) if faces.dtype == np.uint16 else ('<u4', 5125)
+    indices = faces.astype(index_fmt, copy=False)
+    gltf = {
+        "asset": {"version": "2.0", "generator": "AstroTouch fits_to_stl"},
+        "scene": 0,
+        "scenes": [{"nodes": [0]}],
+        "nodes": [{
+            "mesh": 0,
+            "rotation": [-math.sqrt(0.5), 0.0, 0.0, math.sqrt(0.5)],
+            "scale": [0.001, 0.001, 0.001],
+        }],
+        "meshes": [{"primitives": [{"attributes": {"POSITION": 0}, "indices": 1, "mode": 4}]}],
+        "buffers": [{"byteLength": positions.nbytes + indices.nbytes}],
+        "bufferViews": [
+            {"buffer": 0, "byteOffset": 0, "byteLength": positions.nbytes, "target": 34962},
+            {"buffer": 0, "byteOffset": positions.nbytes, "byteLength": indices.nbytes, "target": 34963},
+        ],
+        "accessors": [
+            {"bufferView": 0, "componentType": 5126, "count": len(vertices), "type": "VEC3",
+             "min": vertices.min(axis=0).tolist(), "max": vertices.max(axis=0).tolist()},
+            {"bufferView": 1, "componentType": index_component, "count": faces.size, "type": "SCALAR"},
+        ],
+    }
+    json_chunk = json.dumps(gltf, separators=(',', ':')).encode('utf-8')
+    json_chunk += b' ' * (-len(json_chunk) % 4)
+    bin_len = positions.nbytes + indices.nbytes
+    bin_pad = -bin_len % 4
+    total = 12 + 8 + len(json_chunk) + 8 + bin_len + bin_pad
+    with open(filepath, 'wb') as f:
+        f.write(np.array([0x46546C67, 2, total], dtype='<u4').tobytes())
+        f.write(np.array([len(json_chunk), 0x4E4F534A], dtype='<u4').tobytes())
+        f.write(json_chunk)
+        f.write(np.array([bin_len + bin_pad, 0x004E4942], dtype='<u4').tobytes())
+        positions.tofile(f)
+        indices.tofile(f)
+        f.write(b'\x00' * bin_pad)
+
 
 def create_stl_from_fits(
     fits_filepath,
@@ -19,7 +892,10 @@ def create_stl_from_fits(
     downsample_factor=1,
     nan_value=None,
     border_width_mm=0.0,
-    border_height_mm=0.0
+    border_height_mm=0.0,
+    output_format='stl',
+    use_gpu=None,
+    verbose=True
 ):
     """
     Converts a 2D astronomical image from a FITS file into a 3D printable
@@ -44,6 +920,9 @@ def create_stl_from_fits(
                                  Set to 0 or None to disable smoothing.
         downsample_factor (int): Factor to downsample the image by (e.g., 2 means
                                  halving dimensions). 1 means no downsampling.
+                                 Integer factors average each f x f block of
+                                 pixels (box downsampling); rows/columns left
+                                 over at the far edges are dropped.
         nan_value (float, optional): Value to replace NaN/inf values with.
                                      If None, they are replaced with the minimum
                                      value of the data *after* clipping.
@@ -51,17 +930,38 @@ def create_stl_from_fits(
                                  0 to disable. ### MODIFIED ###
         border_height_mm (float): The height of the border, measured from the base.
                                   E.g., 0.0 makes a flat flange.
+        output_format (str): 'stl' (binary STL), 'ply' (binary PLY) or 'gltf'
+                             (binary glTF, .glb). PLY and glTF store each
+                             vertex once and reference it by index, so the
+                             files are about 3x smaller than STL. A '.gltf'
+                             output path is changed to '.glb'. Any other
+                             value raises ValueError.
+        use_gpu (bool, optional): Run downsampling, smoothing and mesh
+                                  construction on the GPU with CuPy. None (the
+                                  default) uses the GPU only for large images
+                                  when CuPy and a CUDA device are available;
+                                  False never does. Without a usable GPU, or
+                                  if a GPU step fails, the CPU is used.
+        verbose (bool): Print progress messages. Errors and warnings are
+                        printed either way.
     """
+    # Progress messages. When quiet only the printing is skipped; the
+    # f-string arguments are still built, which is negligible next to the
+    # array work.
+    log = print if verbose else lambda *args, **kwargs: None
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"output_format must be one of {OUTPUT_FORMATS}, got {output_format!r}")
+    if output_format == 'gltf':
+        root, ext = os.path.splitext(stl_filepath)
+        if ext.lower() == '.gltf':
+            # A .gltf file is JSON text; the binary container written here
+            # must be named .glb for loaders to recognize it.
+            stl_filepath = root + '.glb'
+            print(f"WARNING: Binary glTF is written as .glb; saving to {stl_filepath} instead.")
 
-    print(f"--- Loading FITS file: {fits_filepath} (HDU {hdu_index}) ---")
+    log(f"--- Loading FITS file: {fits_filepath} (HDU {hdu_index}) ---")
     try:
-        with fits.open(fits_filepath) as hdul:
-            if len(hdul) <= hdu_index:
-                raise ValueError(f"HDU index {hdu_index} out of range. Max index: {len(hdul)-1}")
-            hdu = hdul[hdu_index]
-            if hdu.data is None or hdu.data.ndim != 2:
-                 raise ValueError(f"HDU {hdu_index} does not contain 2D image data.")
-            image_data = hdu.data.astype(np.float32)
+        image_data, all_finite = _read_fits_image(fits_filepath, hdu_index)
     except FileNotFoundError:
         print(f"ERROR: FITS file not found at {fits_filepath}")
         return
@@ -69,12 +969,17 @@ def create_stl_from_fits(
         print(f"ERROR: Could not read FITS file or HDU: {e}")
         return
 
-    print(f"Original image dimensions: {image_data.shape}")
+    assert image_data.dtype == np.float32, image_data.dtype
+    log(f"Original image dimensions: {image_data.shape}")
+
+    if use_gpu and cp is None:
+        print("WARNING: GPU processing requested but CuPy or a usable CUDA device is not available. Using the CPU.")
 
     if downsample_factor > 1:
-        print(f"Downsampling by factor {downsample_factor}...")
-        image_data = zoom(image_data, 1 / downsample_factor, order=1)
-        print(f"New image dimensions: {image_data.shape}")
+        log(f"Downsampling by factor {downsample_factor}...")
+        image_data = _downsample(image_data, downsample_factor, use_gpu)
+        assert image_data.dtype == np.float32, image_data.dtype
+        log(f"New image dimensions: {image_data.shape}")
         if image_data.size == 0:
             print("ERROR: Downsampling resulted in empty image.")
             return
@@ -84,79 +989,104 @@ def create_stl_from_fits(
         print("ERROR: Image dimensions are too small (< 2 pixels).")
         return
 
-    finite_mask = np.isfinite(image_data)
-    has_non_finite = not np.all(finite_mask)
+    # Non-finite pixels are replaced inside the fused _height_map pass below,
+    # so only their count is needed here; it comes out of the same sweep as
+    # the finite min/max, which the statistics below reuse. The boolean mask
+    # is built only when there is something to mask out of the percentiles.
+    # Integer images cannot hold NaN/inf (block means of them cannot either),
+    # so they skip this sweep and get their min/max only if it is needed.
+    if all_finite:
+        num_non_finite, data_minmax = 0, None
+    else:
+        num_non_finite, data_min, data_max = _finite_stats(image_data)
+        data_minmax = (data_min, data_max)
+    has_non_finite = num_non_finite > 0
     if has_non_finite:
-        num_non_finite = np.sum(~finite_mask)
         print(f"WARNING: Found {num_non_finite} NaN/inf values.")
         if nan_value is not None:
-            print(f"Replacing non-finite values with specified value: {nan_value}")
-            image_data[~finite_mask] = nan_value
+            log(f"Replacing non-finite values with specified value: {nan_value}")
         else:
-            print("Non-finite values will be replaced with the data minimum after clipping.")
-            image_data[~finite_mask] = 0
-
-    if clip_percentile and 0 < clip_percentile < 50:
-        print(f"Clipping data to {clip_percentile:.2f}% - {100-clip_percentile:.2f}% percentile range.")
-        data_for_percentile = image_data[finite_mask] if has_non_finite else image_data
-        if data_for_percentile.size > 0:
-            min_val = np.percentile(data_for_percentile, clip_percentile)
-            max_val = np.percentile(data_for_percentile, 100 - clip_percentile)
-            image_data = np.clip(image_data, min_val, max_val)
-            print(f"Data clipped to range: [{min_val:.4g}, {max_val:.4g}]")
+            log("Non-finite values will be replaced with the data minimum after clipping.")
+    num_finite = image_data.size - num_non_finite
+
+    # Work out the value range [min_val, max_val] the data is clipped to. The
+    # actual replacement, clipping and scaling all happen in one fused pass
+    # further down.
+    min_val = max_val = None
+    do_clip = clip_percentile and 0 < clip_percentile < 50
+    if do_clip:
+        log(f"Clipping data to {clip_percentile:.2f}% - {100-clip_percentile:.2f}% percentile range.")
+        if num_finite > 0:
+            min_val, max_val = _percentiles(image_data, [clip_percentile, 100 - clip_percentile],
+                                            skip_nonfinite=has_non_finite, minmax=data_minmax)
+            log(f"Data clipped to range: [{min_val:.4g}, {max_val:.4g}]")
             if has_non_finite and nan_value is None:
-                 print(f"Replacing original NaNs/Infs with clipped minimum: {min_val:.4g}")
-                 image_data[~finite_mask] = min_val
+                 log(f"Replacing original NaNs/Infs with clipped minimum: {min_val:.4g}")
         else:
             print("WARNING: Cannot calculate percentiles, no finite data available.")
 
-    elif has_non_finite and nan_value is None:
-         data_for_min = image_data[finite_mask]
-         replace_val = np.min(data_for_min) if data_for_min.size > 0 else 0
-         print(f"Replacing original NaNs/Infs with global minimum: {replace_val:.4g}")
-         image_data[~finite_mask] = replace_val
+    if min_val is None:
+        if num_finite > 0:
+            min_val, max_val = data_minmax if data_minmax is not None else _finite_minmax(image_data)
+        else:
+            min_val = max_val = np.float32(nan_value if nan_value is not None else 0)
+        if has_non_finite and nan_value is None and not do_clip:
+             log(f"Replacing original NaNs/Infs with global minimum: {min_val:.4g}")
+        if has_non_finite and nan_value is not None:
+            # Nothing is clipped here, so the replacement value widens the range.
+            min_val = min(min_val, np.float32(nan_value))
+            max_val = max(max_val, np.float32(nan_value))
+    # Keep every scalar that meets the image in float32 so no step silently
+    # promotes the whole array to float64.
+    min_val, max_val = np.float32(min_val), np.float32(max_val)
+    replace_val = np.float32(nan_value) if nan_value is not None else min_val
 
+    shift = np.float32(0.0)
     if log_scale:
-        print("Applying log1p scaling (log(1+x))...")
-        min_data = np.min(image_data)
-        if min_data < 0:
-            print(f"  Shifting data by {-min_data:.4g} to make it non-negative before log scaling.")
-            image_data -= min_data
-        image_data = np.log1p(image_data)
+        log("Applying log1p scaling (log(1+x))...")
+        if min_val < 0:
+            log(f"  Shifting data by {-min_val:.4g} to make it non-negative before log scaling.")
+            shift = min_val
 
     if invert:
-        print("Inverting data height...")
-        image_data = -image_data
+        log("Inverting data height...")
 
-    print("Normalizing data for Z-axis...")
-    min_val, max_val = np.min(image_data), np.max(image_data)
-    data_range = max_val - min_val
+    # Every step above is monotonic, so the processed data range follows
+    # from transforming the clip limits themselves.
+    log("Normalizing data for Z-axis...")
+    z_lo, z_hi = min_val, max_val
+    if log_scale:
+        z_lo, z_hi = np.log1p(z_lo - shift), np.log1p(z_hi - shift)
+    if invert:
+        z_lo, z_hi = -z_hi, -z_lo
+    data_range = z_hi - z_lo
 
     if data_range == 0:
         print("WARNING: Data range is zero after processing. Surface will be flat.")
         z_data = np.full(image_data.shape, base_thickness_mm, dtype=np.float32)
     else:
-        z_data = base_thickness_mm + ((image_data - min_val) / data_range) * max_height_mm
-        print(f"Data scaled to Z range: [{base_thickness_mm:.2f} mm, {base_thickness_mm + max_height_mm:.2f} mm]")
+        z_data = _height_map(image_data, min_val, max_val, replace_val, shift, log_scale, invert,
+                             z_lo, np.float32(max_height_mm) / data_range, base_thickness_mm)
+        log(f"Data scaled to Z range: [{base_thickness_mm:.2f} mm, {base_thickness_mm + max_height_mm:.2f} mm]")
 
     if smoothing_sigma and smoothing_sigma > 0:
-        print(f"Applying Gaussian smoothing with sigma={smoothing_sigma}...")
-        z_data = gaussian_filter(z_data, sigma=smoothing_sigma)
-    # --- [END UNCHANGED SECTIONS 1] ---
+        log(f"Applying Gaussian smoothing with sigma={smoothing_sigma}...")
+        z_data = _gaussian_smooth(z_data, smoothing_sigma, use_gpu)
+    assert z_data.dtype == np.float32, z_data.dtype
 
     # --- ### MODIFIED LOGIC (So far it works...): CALCULATE SCALING FACTOR FIRST ### ---
     # We calculate the scale factor based on the *image content* dimensions (ny, nx).
     # This factor (mm per pixel) is then used to determine the border width in pixels.
-    print("Calculating model scaling factor (mm/pixel)...")
+    log("Calculating model scaling factor (mm/pixel)...")
     if longest_side_mm and longest_side_mm > 0:
         # Get dimensions of the image data *before* adding a border
         image_ny, image_nx = z_data.shape
         max_pixel_dim = max(image_nx, image_ny)
         scale_factor = longest_side_mm / max_pixel_dim
-        print(f"Scaling content ({max_pixel_dim} pixels) to {longest_side_mm:.2f} mm. Scale factor: {scale_factor:.4f} mm/pixel.")
+        log(f"Scaling content ({max_pixel_dim} pixels) to {longest_side_mm:.2f} mm. Scale factor: {scale_factor:.4f} mm/pixel.")
     else:
         scale_factor = 1.0
-        print("Using 1-to-1 pixel-to-millimeter scaling.")
+        log("Using 1-to-1 pixel-to-millimeter scaling.")
 
     # --- ### MODIFIED LOGIC: Add Border ### ---
     if border_width_mm > 0:
@@ -164,7 +1094,7 @@ def create_stl_from_fits(
         border_width_pixels = int(round(border_width_mm / scale_factor))
 
         if border_width_pixels > 0:
-            print(f"Adding a {border_width_mm:.2f} mm border ({border_width_pixels} pixels) with height {border_height_mm:.2f} mm.")
+            log(f"Adding a {border_width_mm:.2f} mm border ({border_width_pixels} pixels) with height {border_height_mm:.2f} mm.")
 
             border_z_value = base_thickness_mm + border_height_mm
 
@@ -183,81 +1113,99 @@ def create_stl_from_fits(
             # Update z_data and dimensions for mesh generation
             z_data = z_data_bordered
             ny, nx = ny_new, nx_new # These are the final dimensions for the mesh grid
-            print(f"Total dimensions with border: {z_data.shape}")
+            log(f"Total dimensions with border: {z_data.shape}")
         else:
             print(f"WARNING: Border width {border_width_mm} mm is too small to represent at the current scale. Border skipped.")
 
     # --- ### MODIFIED LOGIC: Print final dimensions ### ---
     final_x_mm = nx * scale_factor
     final_y_mm = ny * scale_factor
-    print(f"Final model base dimensions: {final_x_mm:.2f} mm x {final_y_mm:.2f} mm.")
+    log(f"Final model base dimensions: {final_x_mm:.2f} mm x {final_y_mm:.2f} mm.")
 
     # --- Mesh Generation ---
     # This part now uses the final 'nx' and 'ny' (which may include the border)
     # and the pre-calculated 'scale_factor' to create the physical mesh.
-    print("Generating mesh vertices...")
+    # Vertex coordinates are never stored as a full (2*nx*ny, 3) array. The
+    # grid is regular, so x and y follow from a vertex's column and row, and
+    # the bottom layer only differs from the top by z=0.
+    log("Generating mesh vertex coordinates...")
     x = np.arange(nx, dtype=np.float32) * scale_factor
     y = np.arange(ny, dtype=np.float32) * scale_factor
-    xx, yy = np.meshgrid(x, y)
+    # Every stage above returns a fresh C-ordered array, so this is a no-op
+    # check; it keeps the mesh fill (and the Numba kernel's C-layout
+    # specialization) on unit-stride rows should that ever change.
+    z_data = np.ascontiguousarray(z_data)
+    assert z_data.dtype == x.dtype == y.dtype == np.float32
 
-    # --- [UNCHANGED SECTIONS 2: Mesh faces, saving, etc.] ---
     num_vertices = nx * ny
-    vertices = np.zeros((num_vertices * 2, 3), dtype=np.float32)
-    vertices[:num_vertices, 0] = xx.flatten()
-    vertices[:num_vertices, 1] = yy.flatten()
-    vertices[:num_vertices, 2] = z_data.flatten()
-    vertices[num_vertices:, 0] = xx.flatten()
-    vertices[num_vertices:, 1] = yy.flatten()
-    vertices[num_vertices:, 2] = 0.0
-
-    print("Generating mesh faces...")
+
+    if output_format != 'stl':
+        log("Generating mesh faces...")
+        try:
+            faces = _cached_grid_faces(nx, ny)
+        except ValueError as e:
+            print(f"ERROR: Could not build {output_format.upper()} mesh: {e}")
+            return
+        vertices = _grid_vertices(x, y, z_data)
+        log(f"Creating indexed mesh ({len(vertices)} vertices, {len(faces)} faces)...")
+        writer = _write_ply if output_format == 'ply' else _write_glb
+        log(f"Saving {output_format.upper()} file to: {stl_filepath}")
+        try:
+            writer(stl_filepath, vertices, faces)
+            log(f"--- {output_format.upper()} file saved successfully! ---")
+        except Exception as e:
+            print(f"ERROR: Could not save {output_format.upper()} file: {e}")
+        return
+
+    log("Generating mesh faces...")
     num_faces_per_surface = 2 * (nx - 1) * (ny - 1)
     num_side_faces = 2 * (nx - 1) + 2 * (ny - 1)
     total_faces = (num_faces_per_surface * 2) + (num_side_faces * 2)
-    faces = np.zeros((total_faces, 3), dtype=np.uint32)
-
-    face_idx = 0
-    base_offset = num_vertices
-    for j in range(ny - 1):
-        for i in range(nx - 1):
-            v00, v10 = j * nx + i, j * nx + (i + 1)
-            v01, v11 = (j + 1) * nx + i, (j + 1) * nx + (i + 1)
-            faces[face_idx] = [v00, v10, v01]; face_idx += 1
-            faces[face_idx] = [v10, v11, v01]; face_idx += 1
-    for j in range(ny - 1):
-        for i in range(nx - 1):
-            v00, v10 = base_offset + j * nx + i, base_offset + j * nx + (i + 1)
-            v01, v11 = base_offset + (j + 1) * nx + i, base_offset + (j + 1) * nx + (i + 1)
-            faces[face_idx] = [v00, v01, v10]; face_idx += 1
-            faces[face_idx] = [v10, v01, v11]; face_idx += 1
-    for i in range(nx - 1):
-        v_t0, v_t1 = i, i + 1
-        v_b0, v_b1 = base_offset + i, base_offset + i + 1
-        faces[face_idx] = [v_t0, v_b0, v_b1]; face_idx += 1
-        faces[face_idx] = [v_t0, v_b1, v_t1]; face_idx += 1
-        v_t0, v_t1 = (ny - 1) * nx + i, (ny - 1) * nx + i + 1
-        v_b0, v_b1 = base_offset + (ny - 1) * nx + i, base_offset + (ny - 1) * nx + i + 1
-        faces[face_idx] = [v_t0, v_b1, v_b0]; face_idx += 1
-        faces[face_idx] = [v_t0, v_t1, v_b1]; face_idx += 1
-    for j in range(ny - 1):
-        v_t0, v_t1 = j * nx, (j + 1) * nx
-        v_b0, v_b1 = base_offset + j * nx, base_offset + (j + 1) * nx
-        faces[face_idx] = [v_t0, v_b1, v_b0]; face_idx += 1
-        faces[face_idx] = [v_t0, v_t1, v_b1]; face_idx += 1
-        v_t0, v_t1 = j * nx + (nx - 1), (j + 1) * nx + (nx - 1)
-        v_b0, v_b1 = base_offset + j * nx + (nx - 1), base_offset + (j + 1) * nx + (nx - 1)
-        faces[face_idx] = [v_t0, v_b0, v_b1]; face_idx += 1
-        faces[face_idx] = [v_t0, v_b1, v_t1]; face_idx += 1
-
-    print(f"Creating STL mesh object ({len(vertices)} vertices, {len(faces)} faces)...")
-    surface_mesh = mesh.Mesh(np.zeros(faces.shape[0], dtype=mesh.Mesh.dtype))
-    surface_mesh.vectors = vertices[faces]
-    print(f"Saving STL file to: {stl_filepath}")
+
+    # Triangle coordinates are written straight into the STL records from
+    # shifted slices of the grid, so no face index array is built here. The
+    # fill and the normals are independent per face, so large meshes are
+    # built on the GPU when CuPy is available.
+    # CuPy has no structured dtypes; the results are copied into the STL
+    # records on the host band by band.
+    mesh_on_gpu = _use_gpu(num_vertices, use_gpu)
+    log(f"Creating STL mesh ({num_vertices * 2} vertices, {total_faces} faces)...")
+    # A memory-mapped mesh is built in a temporary file next to the output
+    # and only renamed onto it once complete, so a failed or interrupted run
+    # never leaves a full-size, valid-looking but empty STL behind.
+    memmap_path = stl_filepath + '.part' if total_faces >= MEMMAP_MIN_FACES else None
+    if memmap_path:
+        log("  Large mesh: building it directly in a memory-mapped file on disk.")
     try:
-        surface_mesh.save(stl_filepath)
-        print("--- STL file saved successfully! ---")
-    except Exception as e:
-        print(f"ERROR: Could not save STL file: {e}")
+        stl_buf, rec = _new_stl_buffer(total_faces, memmap_path)
+    except OSError as e:
+        print(f"ERROR: Could not create STL file: {e}")
+        return
+    try:
+        if mesh_on_gpu:
+            log("  Building mesh on the GPU (CuPy).")
+            try:
+                _fill_grid_mesh_gpu(rec['vectors'], rec['normals'], x, y, z_data)
+            except GPU_ERRORS as e:
+                print(f"WARNING: Building the mesh on the GPU failed ({e}). Building it on the CPU instead.")
+                mesh_on_gpu = False
+        if not mesh_on_gpu:
+            _fill_grid_mesh(rec['vectors'], rec['normals'], x, y, z_data)
+
+        log(f"Saving STL file to: {stl_filepath}")
+        try:
+            _write_binary_stl(stl_filepath, stl_buf)
+            if memmap_path:
+                # Drop the mapping before the rename (required on Windows).
+                del stl_buf, rec
+                os.replace(memmap_path, stl_filepath)
+                memmap_path = None
+            log("--- STL file saved successfully! ---")
+        except Exception as e:
+            print(f"ERROR: Could not save STL file: {e}")
+    finally:
+        if memmap_path and os.path.exists(memmap_path):
+            os.remove(memmap_path)
 
 
 if __name__ == "__main__":
@@ -267,7 +1215,7 @@ if __name__ == "__main__":
     )
     # --- Command-line arguments ---
     parser.add_argument("fits_file", help="Path to the input FITS file.")
-    parser.add_argument("stl_file", help="Path for the output STL file.")
+    parser.add_argument("stl_file", help="Path for the output mesh file.")
     parser.add_argument("--hdu", type=int, default=0, help="Index of the HDU containing the 2D image data.")
     parser.add_argument(
         "--longest_side", type=float, default=None, metavar="MM",
@@ -288,6 +1236,10 @@ if __name__ == "__main__":
     parser.add_argument("--border_width_mm", type=float, default=0.0, metavar="MM", help="Add a border around the model with this width in millimeters. 0 disables the border.")
     parser.add_argument("--border_height", type=float, default=0.0, metavar="MM", help="Set the height of the border, measured from the base plate (in mm). For a flat flange, use 0.")
 
+    parser.add_argument("--gpu", choices=("auto", "on", "off"), default="auto", help="Run downsampling, smoothing and mesh construction on an NVIDIA GPU via CuPy. 'auto' uses the GPU for large images when CuPy is installed.")
+    parser.add_argument("--quiet", action="store_true", help="Only print errors and warnings.")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default="stl", help="Output mesh format. 'ply' and 'gltf' (.glb) share vertices between triangles and are ~3x smaller than STL.")
+
     args = parser.parse_args()
 
     # --- Argument Validation ---
@@ -314,5 +1266,8 @@ if __name__ == "__main__":
         downsample_factor=args.downsample,
         nan_value=args.nan_value,
         border_width_mm=args.border_width_mm,
-        border_height_mm=args.border_height
+        border_height_mm=args.border_height,
+        output_format=args.format,
+        use_gpu={"auto": None, "on": True, "off": False}[args.gpu],
+        verbose=not args.quiet
     )